@@ -0,0 +1,115 @@
+# cython: language_level=3
+##
+# This file is part of the libsigrokdecode project.
+##
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+##
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+##
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>.
+##
+
+'''
+Compiled KS0107/8 command/page state machine.
+
+Build in place with "cythonize -i _fast.pyx". pd.py uses it for decode()
+when it is importable and falls back to the pure Python loop otherwise.
+'''
+
+cimport cython
+
+cdef enum:
+    COMMAND_SIZE = 3
+    PAGE_SIZE = 132
+
+# Same codes as the S_* constants in pd.py
+cdef enum:
+    FIND_START = 0
+    VERIFY_START = 1
+    FIND_NEXT_START_CLK = 2
+    READ_DATA = 3
+
+
+cdef class FastDecoder:
+    cdef public int state
+    cdef public bint cs1_device
+    cdef long long verify_window
+    cdef long long clk_lo
+    cdef long long clk_hi
+    cdef long long potential_start
+    cdef long long start_clk_samplenum
+    cdef int clk_cnt
+    cdef int ndata
+    cdef unsigned char cmd[COMMAND_SIZE]
+    cdef unsigned char buf[PAGE_SIZE]
+
+    def __init__(self, long long verify_window, long long clk_lo,
+                 long long clk_hi):
+        # Timing windows in samples, see Decoder.start()
+        self.verify_window = verify_window
+        self.clk_lo = clk_lo
+        self.clk_hi = clk_hi
+        self.state = FIND_START
+        self.cs1_device = False
+        self.clk_cnt = 0
+        self.ndata = 0
+
+    @property
+    def command(self):
+        return [self.cmd[i] for i in range(self.clk_cnt)]
+
+    @property
+    def data(self):
+        return bytearray((<char *>self.buf)[:self.ndata])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cpdef tuple step(self, int cs1, int cs2, int clk, int rw, int e, int d,
+                     long long samplenum):
+        cdef bint page_done = False
+        cdef int byte = -1
+        cdef long long delta
+
+        if self.state == FIND_START:
+            self.clk_cnt = 0
+            self.potential_start = samplenum
+            self.state = VERIFY_START
+        elif self.state == VERIFY_START:
+            delta = samplenum - self.potential_start
+            if delta < self.verify_window:
+                byte = d
+                self.cmd[self.clk_cnt] = d
+                self.clk_cnt += 1
+                self.start_clk_samplenum = samplenum
+                self.state = FIND_NEXT_START_CLK
+            else:
+                self.state = FIND_START
+        elif self.state == FIND_NEXT_START_CLK:
+            delta = samplenum - self.start_clk_samplenum
+            if self.clk_lo < delta < self.clk_hi:
+                byte = d
+                self.cmd[self.clk_cnt] = d
+                self.clk_cnt += 1
+                self.start_clk_samplenum = samplenum
+            else:
+                self.state = FIND_START
+            if self.clk_cnt == COMMAND_SIZE:
+                self.ndata = 0
+                self.state = READ_DATA
+        elif self.state == READ_DATA:
+            byte = d
+            self.buf[self.ndata] = d
+            self.ndata += 1
+            if self.ndata == PAGE_SIZE:
+                self.cs1_device = cs2 and not cs1
+                page_done = True
+                self.state = FIND_START
+
+        return (self.state, page_done, byte)
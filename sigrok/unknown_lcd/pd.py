@@ -17,10 +17,23 @@
 # along with this program; if not, see <http://www.gnu.org/licenses/>.
 ##
 import sys
+import math
+import time
+import ctypes
+import numpy as np
 import sdl2
 import sdl2.ext
 import sigrokdecode as srd
-from common.srdhelper import bitpack
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    from ._fast import FastDecoder
+except ImportError:
+    FastDecoder = None
 
 '''
 OUTPUT_PYTHON format:
@@ -58,28 +71,15 @@ Packet:
 
 
 def channel_list(num_channels):
-    # l = [{'id': 'cs1', 'name': 'CS1', 'desc': 'Cable select 1'},
-    #      {'id': 'cs2', 'name': 'CS2', 'desc': 'Cable select 2'},
-    #      {'id': 'rst', 'name': 'RST', 'desc': 'Reset - Active high'},
-    #      {'id': 'rw', 'name': 'R/W', 'desc': 'Read/Write'},
-    #      {'id': 'di', 'name': 'DI/RS', 'desc': 'Data Instruction'},
-    #      {'id': 'en', 'name': 'Enable', 'desc': 'Clock operation enable'}
-    #      ]
-    # l = []
-
-    l = [{'id': 'cs1', 'name': 'CS1', 'desc': 'Chip Select 1'},
-         {'id': 'cs2', 'name': 'CS2', 'desc': 'Chip Select 2'},
-         {'id': 'clk', 'name': 'Clock', 'desc': 'Clock'},
-         {'id': 'rw', 'name': 'RW', 'desc': 'RW'},
-         {'id': 'e', 'name': 'Enable', 'desc': 'Enable device'}]
-    # for i in range(num_channels):
-    #     d = {'id': 'd%d' % i, 'name': 'D%d' % i, 'desc': 'Data line %d' % i}
-
-    for i in range(num_channels):
-        d = {'id': 'd%d' % i, 'name': 'D%d' % i, 'desc': 'Data line %d' % i}
-        l.append(d)
-
-    return tuple(l)
+    return (
+        {'id': 'cs1', 'name': 'CS1', 'desc': 'Chip Select 1'},
+        {'id': 'cs2', 'name': 'CS2', 'desc': 'Chip Select 2'},
+        {'id': 'clk', 'name': 'Clock', 'desc': 'Clock'},
+        {'id': 'rw', 'name': 'RW', 'desc': 'RW'},
+        {'id': 'e', 'name': 'Enable', 'desc': 'Enable device'},
+    ) + tuple(
+        {'id': 'd%d' % i, 'name': 'D%d' % i, 'desc': 'Data line %d' % i}
+        for i in range(num_channels))
 
 
 class ChannelError(Exception):
@@ -88,6 +88,48 @@ class ChannelError(Exception):
 
 NUM_CHANNELS = 8
 
+# Per-edge tracing; far too slow to leave on for real captures
+DEBUG = False
+
+# Buffered item annotations are flushed at the latest after this many
+MAX_BUF = 4096
+
+# Set-page commands are PAGE_BASE + page
+PAGE_BASE = 176
+NUM_PAGES = 8
+# Data bytes per page write, one per column of a controller half
+PAGE_SIZE = 132
+
+# Minimum time between two presented frames, in seconds (~60 Hz)
+FRAME_INTERVAL = 0.016
+
+# Data bit shown on each row of a page, top to bottom
+ROW_BITS = (0, 1, 2, 3, 4, 5, 6, 7)
+
+# Chip select edge that opens a transfer, then clock edges while selected
+START_CONDITIONS = [{1: 'h', 0: 'f'}, {0: 'h', 1: 'f'}]
+CLK_CONDITIONS = [{1: 'h', 0: 'l', 2: 'r'}, {0: 'h', 1: 'l', 2: 'r'}]
+
+# State codes, shared with the FastDecoder enum in _fast.pyx
+S_FIND_START = 0
+S_VERIFY_START = 1
+S_FIND_NEXT_CLK = 2
+S_READ_DATA = 3
+WAIT_CONDITIONS = (START_CONDITIONS, CLK_CONDITIONS,
+                   CLK_CONDITIONS, CLK_CONDITIONS)
+
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False)
+    def _unpack_page(data, shifts, argb, out):
+        # out[y, i] is the pixel for bit shifts[y] of byte i
+        for i in range(out.shape[1]):
+            v = data[i]
+            for y in range(out.shape[0]):
+                out[y, i] = argb[(v >> shifts[y]) & 1]
+else:
+    _unpack_page = None
+
 
 class Decoder(srd.Decoder):
     api_version = 3
@@ -123,47 +165,104 @@ class Decoder(srd.Decoder):
         self.reset()
 
     def reset(self):
-        self.state = 'FIND START'
+        self.state = S_FIND_START
         self.lcd_width = 264
         self.lcd_height = 64
         self.window = sdl2.ext.Window(
             "LCD Monochrome Display", size=(self.lcd_width, self.lcd_height))
         self.window.show()
+        # Let SDL queue render commands instead of flushing per primitive
+        sdl2.SDL_SetHint(b"SDL_RENDER_BATCHING", b"1")
         self.renderer = sdl2.ext.Renderer(self.window)
+        # Pixel colors for a 0 and a 1 bit, built once and mapped to ARGB8888
+        self._colors = (sdl2.ext.Color(0, 0, 0), sdl2.ext.Color(255, 255, 255))
+        self._argb_lut = np.array(
+            [(c.a << 24) | (c.r << 16) | (c.g << 8) | c.b for c in self._colors],
+            dtype=np.uint32)
+        # Persistent ARGB8888 texture; pages are uploaded into it as they
+        # arrive, so it starts out blanked once here
+        self.tex = sdl2.SDL_CreateTexture(
+            self.renderer.sdlrenderer, sdl2.SDL_PIXELFORMAT_ARGB8888,
+            sdl2.SDL_TEXTUREACCESS_STREAMING, self.lcd_width, self.lcd_height)
+        blank = np.full((self.lcd_height, self.lcd_width), self._argb_lut[0],
+                        dtype=np.uint32)
+        sdl2.SDL_UpdateTexture(
+            self.tex, None, blank.ctypes.data, self.lcd_width*4)
+        self._patch = np.empty((8, PAGE_SIZE), dtype=np.uint32)
+        self._last_present = 0.0
+        self._row_shifts = np.array(ROW_BITS, dtype=np.uint8)
+        if _unpack_page is not None:
+            # Compile (or load from cache) now rather than on the first page;
+            # updateLCD always passes a bytearray-backed, writable array
+            _unpack_page(np.frombuffer(bytearray(PAGE_SIZE), np.uint8),
+                         self._row_shifts, self._argb_lut, self._patch)
         self.items = []
         self.saved_item = None
         self.ss_item = self.es_item = None
+        self._ann_buf = []
+        self.clk_cnt = 0
+        self.command = []
+        self.data_bytes = bytearray(PAGE_SIZE)
+        self.ndata = 0
+        self.potential_start = self.start_clk_samplenum = 0
         self.saved_word = None
         self.ss_word = self.es_word = None
         self.first = True
         self.ann = ["Start", "St", "S"]
         self.last_rw = 0
         self.last_cs1 = 0
-        self.pages=[]
-        [self.pages.append(i) for i in range(176,184)]
 
     def get_sample_length(self, num_samples):
-        return 1/float(self.options['sample_rate'])*num_samples
+        return num_samples*self._inv_rate
 
     def get_time(self, samplenum):
-        return round(1/float(self.options['sample_rate'])*1000*samplenum, 5)
+        return samplenum*self.ms_per_sample
 
     def start(self):
         self.out_python = self.register(srd.OUTPUT_PYTHON)
         self.out_ann = self.register(srd.OUTPUT_ANN)
+        self._sample_rate = float(self.options['sample_rate'])
+        self._inv_rate = 1.0/self._sample_rate
+        self.ms_per_sample = 1000.0*self._inv_rate
+        # Timing windows as integer sample counts. For an integer delta,
+        # delta < x <=> delta < ceil(x) and x < delta <=> floor(x) < delta;
+        # round() keeps float noise from moving a bound by one sample.
+        # An edge landing exactly on a window boundary (e.g. 42 samples =
+        # 4.2us at 10 MHz) is always rejected.
+        self._verify_window = math.ceil(round(2.40e-6*self._sample_rate, 6))
+        self._clk_lo = math.floor(round(3.7e-6*self._sample_rate, 6))
+        self._clk_hi = math.ceil(round(4.2e-6*self._sample_rate, 6))
 
     def putpb(self, data):
-        self.put(self.ss_item, self.es_item, self.out_python, data)
+        self._ann_buf.append((self.ss_item, self.es_item, self.out_python, data))
+        if len(self._ann_buf) >= MAX_BUF:
+            self._flush_ann()
 
     def putb(self, data):
-        self.put(self.ss_item, self.es_item, self.out_ann, data)
+        self._ann_buf.append((self.ss_item, self.es_item, self.out_ann, data))
+        if len(self._ann_buf) >= MAX_BUF:
+            self._flush_ann()
 
     def putpw(self, data):
+        self._flush_ann()
         self.put(self.ss_word, self.es_word, self.out_python, data)
 
     def putw(self, data):
+        self._flush_ann()
         self.put(self.ss_word, self.es_word, self.out_ann, data)
 
+    def _flush_ann(self):
+        put = self.put
+        for ss, es, output, data in self._ann_buf:
+            put(ss, es, output, data)
+        self._ann_buf.clear()
+
+    def _pack_data(self, pins):
+        # D0..D7 follow the 5 control channels in the wait() result
+        return (pins[5] | (pins[6] << 1) | (pins[7] << 2) | (pins[8] << 3) |
+                (pins[9] << 4) | (pins[10] << 5) | (pins[11] << 6) |
+                (pins[12] << 7))
+
     def handle_bits(self, item, used_pins):
 
         if self.first:
@@ -179,26 +278,37 @@ class Decoder(srd.Decoder):
 
         # self.put(self.samplenum, 20, self.out_ann, [4, ['Start', 'St', 'S']])
 
-    def updateLCD(self, cs1_device, command, bytes):
-        page=self.pages.index(command[0])
-        print("updateLCD", "CS1" if cs1_device else "CS2", command[0], len(bytes))
-        print("Page", self.pages.index(command[0]))
-        for i in range(len(bytes)):
-            line="".join(reversed('{:08b}'.format(bytes[i])))
-            mapping = [7,1,2,3,4,5,6,0]
-            for y in range(8):
-                try:
-                    # y_mapped=mapping.index(int(y))
-                    color = (0,0,0) if line[y] == '0' else (255,255,255)
-                    self.renderer.draw_point([i+(0 if cs1_device else 132),y+(8*page)], sdl2.ext.Color(*color))
-                    
-                    
-                except Exception as e:
-                    print("somethings wrong", e)
-        self.window.refresh()
+    def updateLCD(self, cs1_device, command, data_bytes):
+        page = command[0] - PAGE_BASE
+        if not 0 <= page < NUM_PAGES:
+            return
+        if DEBUG:
+            print("updateLCD", "CS1" if cs1_device else "CS2", command[0], len(data_bytes))
+            print("Page", page)
+        x0 = 0 if cs1_device else PAGE_SIZE
+        y0 = 8*page
+        data = np.frombuffer(data_bytes, np.uint8)
+        if _unpack_page is not None:
+            _unpack_page(data, self._row_shifts, self._argb_lut, self._patch)
+        else:
+            # bits[i, y] is the ROW_BITS[y] bit of byte i
+            bits = (data[:, None] >> self._row_shifts) & 1
+            np.take(self._argb_lut, bits.T, out=self._patch)
+        # Only the PAGE_SIZE x 8 page changed, upload just that rectangle
+        rect = sdl2.SDL_Rect(x0, y0, PAGE_SIZE, 8)
+        sdl2.SDL_UpdateTexture(
+            self.tex, ctypes.byref(rect), self._patch.ctypes.data,
+            PAGE_SIZE*4)
+        # Page writes in between are coalesced into the next frame
+        if time.monotonic() - self._last_present >= FRAME_INTERVAL:
+            self.present()
+
+    def present(self):
+        sdl2.SDL_RenderCopy(self.renderer.sdlrenderer, self.tex, None, None)
         self.renderer.present()
-        
-    def decode(self):
+        self._last_present = time.monotonic()
+
+    def check_channels(self):
         max_possible = len(self.optional_channels)
         idx_channels = [
             idx if self.has_channel(idx) else None
@@ -216,122 +326,96 @@ class Decoder(srd.Decoder):
         num_digits = (num_item_bits + 3) // 4
         self.fmt_item = "{{:0{}x}}".format(num_digits)
 
-        previous_cs1_sample = 0
-        previous_cs2_sample = 0
-        cs1_count = 0
-        cs2_count = 0
-
-        cs1e = False
-        prev_cs1 = 1
-        prev_cs2 = 1
-        prev_clk = 0
-        prev_clk_cmd_count = 0
-        prev_clk_sample = 0
-        clk_cnt = 0
-        start_clk_samplenum = 0
-        command = []
-        data_bytes = []
-        while True:
-
-            if self.state == 'FIND START':
-                clk_cnt = 0
-                command = []
-                self.wait([{1: 'h', 0: 'f'}, {0: 'h', 1: 'f'}])
-                print("FIND START", self.get_time(self.samplenum))
-                potential_start = self.samplenum
-                self.state = 'VERIFY START'
-            elif (self.state == 'VERIFY START'):
-                (cs1, cs2, clk, rw, e, d0, d1, d2, d3, d4, d5, d6, d7) = self.wait(
-                    [{1: 'h', 0: 'l', 2: 'r'}, {0: 'h', 1: 'l', 2: 'r'}])
-
-                print("VERIFY START", self.get_time(self.samplenum))
-                current_time = self.get_time(self.samplenum)*1000
-                potential_start_time = self.get_time(potential_start)*1000
-                if(current_time-potential_start_time < 2.40):
-                    command.append(bitpack((d0, d1, d2, d3, d4, d5, d6, d7)))
-                    self.state = "FIND NEXT START CLK"
-                    start_clk_samplenum = self.samplenum
-                    clk_cnt += 1
-                else:
-                    self.state = 'FIND START'
-            elif (self.state == 'FIND NEXT START CLK'):
-
-                (cs1, cs2, clk, rw, e, d0, d1, d2, d3, d4, d5, d6, d7) = self.wait(
-                    [{1: 'h', 0: 'l', 2: 'r'}, {0: 'h', 1: 'l', 2: 'r'}])
-                print("FIND NEXT START CLK", self.get_time(self.samplenum))
-                start_clk_time = self.get_time(start_clk_samplenum)*1000
-                current_clk_time = self.get_time(self.samplenum)*1000
-                # print("current_clk_time - start_clk_time", current_clk_time - start_clk_time)
-                if(3.7 < (current_clk_time - start_clk_time) < 4.2):
-                    start_clk_samplenum = self.samplenum
-                    print("next start clk", self.get_time(self.samplenum))
-                    print("cs1 cs2 clk", cs1, cs2, clk)
-                    command.append(bitpack((d0, d1, d2, d3, d4, d5, d6, d7)))
-                    clk_cnt += 1
-                else:
-                    self.state = 'FIND START'
-                if(clk_cnt == 3):
-                    print("clk 3", self.get_time(self.samplenum))
-                    print("command", command)
-                    self.state = 'READ DATA'
-                    data_bytes = []
-            elif (self.state == 'READ DATA'):
-                (cs1, cs2, clk, rw, e, d0, d1, d2, d3, d4, d5, d6, d7) = self.wait(
-                    [{1: 'h', 0: 'l', 2: 'r'}, {0: 'h', 1: 'l', 2: 'r'}])
-                byte = bitpack((d0, d1, d2, d3, d4, d5, d6, d7))
-                data_bytes.append(byte)
-
-                if(len(data_bytes) == 132):
-                    print("bytes", data_bytes, command)
-                    cs1_device = cs2 and not cs1
-                    self.updateLCD(cs1_device, command, data_bytes)
-                    self.state = 'FIND START'
-
-            # (cs1, cs2, clk, rw, e, d0, d1, d2, d3, d4, d5, d6, d7) = self.wait([{0:'h',1:'l'},{0:'l',1:'h'},{2:'r'}])
-            # pins = (cs1, cs2, clk, rw, e, d0, d1, d2, d3, d4, d5, d6, d7)
-
-            # # print(self.matched)
-            # if self.matched == (False, True, True):
-            #     print("cs1 clk", self.get_time(self.samplenum))
-
-            # if self.matched == (True, False, True):
-            #     print("cs2 clk", self.get_time(self.samplenum))
-
-            # if(not cs2 and prev_cs2):
-            #     cs2e=True
-            #     print("edge cs2", self.get_time(self.samplenum))
-
-            # else:
-            #     cs2e=False
-            # if(not cs1 and prev_cs1):
-            #     cs1e=True
-            #     print("edge cs1", self.get_time(self.samplenum))
-            # else:
-            #     cs1e=False
-            # prev_cs1=cs1
-            # prev_cs2=cs2
-            # if(clk and not prev_clk):
-            #     prev_clk_time = self.get_time(prev_clk_sample)*1000
-            #     cur_clk_time = self.get_time(self.samplenum)*1000
-            #     # print(cur_clk_time, prev_clk_time, cur_clk_time - prev_clk_time)
-            #     if(prev_clk_sample==0 or ((cur_clk_time - prev_clk_time) > 3.8 and (cur_clk_time - prev_clk_time) < 4.5)):
-            #         print("rising clk cmd", self.get_time(self.samplenum))
-            #         prev_clk_cmd_count+=1
-            #     prev_clk_sample= 0 if prev_clk_cmd_count==2 else self.samplenum
-            # prev_clk=clk
-
-            # previous_sample_time=self.get_time(previous_cs1_sample)
-            # current_sample_time=self.get_time(self.samplenum)
-            # cs_take_sample = previous_cs1_sample == 0 or (current_sample_time - previous_sample_time > 0.830 and current_sample_time - previous_sample_time < 0.84)
-            # if(cs_take_sample):
-            #     print("page",self.get_time(self.samplenum))
-            #     while(cs1):
-            #         self.wait({2:'r'})
-            #         print("clk", self.get_time(self.samplenum))
-            # previous_cs1_sample = self.samplenum
-
-            # pins = (cs1,  cs2, clk, rw, e, d0, d1, d2, d3, d4, d5, d6, d7)
-            # bits = [0 if idx is None else pins[idx] for idx in idx_channels]
-            # item = bitpack(bits[1:idx_strip])
-            # self.handle_bits(item, num_item_bits)
-            # print(self.get_time(self.samplenum))
+    def _st_find_start(self):
+        self.clk_cnt = 0
+        self.command = []
+        self.wait(START_CONDITIONS)
+        if DEBUG:
+            print("FIND START", self.get_time(self.samplenum))
+        self.potential_start = self.samplenum
+        return S_VERIFY_START
+
+    def _st_verify_start(self):
+        pins = self.wait(CLK_CONDITIONS)
+        if DEBUG:
+            print("VERIFY START", self.get_time(self.samplenum))
+        # CLK within 2.40us of the chip select edge
+        if (self.samplenum - self.potential_start) < self._verify_window:
+            self.command.append(self._pack_data(pins))
+            self.start_clk_samplenum = self.samplenum
+            self.clk_cnt += 1
+            return S_FIND_NEXT_CLK
+        return S_FIND_START
+
+    def _st_find_next_clk(self):
+        pins = self.wait(CLK_CONDITIONS)
+        if DEBUG:
+            print("FIND NEXT START CLK", self.get_time(self.samplenum))
+        # next CLK 3.7us..4.2us after the previous one
+        d = self.samplenum - self.start_clk_samplenum
+        if not self._clk_lo < d < self._clk_hi:
+            return S_FIND_START
+        self.start_clk_samplenum = self.samplenum
+        if DEBUG:
+            print("next start clk", self.get_time(self.samplenum))
+            print("cs1 cs2 clk", pins[0], pins[1], pins[2])
+        self.command.append(self._pack_data(pins))
+        self.clk_cnt += 1
+        if self.clk_cnt == 3:
+            if DEBUG:
+                print("clk 3", self.get_time(self.samplenum))
+                print("command", self.command)
+            self.ndata = 0
+            return S_READ_DATA
+        return S_FIND_NEXT_CLK
+
+    def _st_read_data(self):
+        pins = self.wait(CLK_CONDITIONS)
+        self.data_bytes[self.ndata] = self._pack_data(pins)
+        self.ndata += 1
+        if self.ndata == PAGE_SIZE:
+            if DEBUG:
+                print("bytes", self.data_bytes, self.command)
+            cs1_device = pins[1] and not pins[0]
+            self.updateLCD(cs1_device, self.command, self.data_bytes)
+            self._flush_ann()
+            return S_FIND_START
+        return S_READ_DATA
+
+    def decode(self):
+        self.check_channels()
+        # Indexed by the S_* state codes
+        handlers = (self._st_find_start, self._st_verify_start,
+                    self._st_find_next_clk, self._st_read_data)
+        try:
+            while True:
+                self.state = handlers[self.state]()
+        finally:
+            # Emit what is still buffered and show the pages written since
+            # the last frame
+            self._flush_ann()
+            self.present()
+
+    def _decode_fast(self):
+        self.check_channels()
+        fast = FastDecoder(
+            self._verify_window, self._clk_lo, self._clk_hi)
+        state = S_FIND_START
+        try:
+            while True:
+                pins = self.wait(WAIT_CONDITIONS[state])
+                state, page_done, byte = fast.step(
+                    pins[0], pins[1], pins[2], pins[3], pins[4],
+                    self._pack_data(pins), self.samplenum)
+                if page_done:
+                    self.updateLCD(fast.cs1_device, fast.command, fast.data)
+                    self._flush_ann()
+        finally:
+            self._flush_ann()
+            self.present()
+
+
+# The compiled state machine has no trace output, so DEBUG keeps the
+# Python one
+if FastDecoder is not None and not DEBUG:
+    Decoder.decode = Decoder._decode_fast